@@ -17,9 +17,11 @@ midi_to_buzzer.py
 - 当同一时刻出现多个同时发声（和弦）时，脚本只选取“最响（velocity 最大）”
   的音符作为单声道输出，这是为了适配只能播放单音的蜂鸣器。
 """
+import os
 import sys
-import math
-from collections import defaultdict
+import heapq
+import itertools
+from array import array
 
 try:
     import mido
@@ -28,6 +30,16 @@ except ImportError:
     sys.exit(2)
 
 
+# MIDI 音符号只有 0..127，预先算好对应频率（Hz），转换时直接查表
+_MIDI_FREQ = tuple(int(round(440.0 * (2.0 ** ((n - 69) / 12.0)))) for n in range(128))
+
+# 关心的消息类型映射为小整数编码，其余消息在读取轨道时直接丢弃
+_MSG_NOTE_ON = 0
+_MSG_NOTE_OFF = 1
+_MSG_SET_TEMPO = 2
+_MSG_CODES = {'note_on': _MSG_NOTE_ON, 'note_off': _MSG_NOTE_OFF, 'set_tempo': _MSG_SET_TEMPO}
+
+
 def note_to_freq(n):
     """
     将 MIDI 音符号（数字）转换为频率（Hz）。
@@ -41,8 +53,9 @@ def note_to_freq(n):
     说明：
     - 公式：440 * 2^((n - 69) / 12)，每个半音频率乘以 2 的 1/12 次方。
     - 返回整数是为了方便在微控制器上直接用整数频率控制定时。
+    - 结果直接取自模块级查找表 `_MIDI_FREQ`，n 需在 0..127 范围内。
     """
-    return int(round(440.0 * (2 ** ((n - 69) / 12.0))))
+    return _MIDI_FREQ[n]
 
 
 def ticks_to_ms(ticks, tempo, ticks_per_beat):
@@ -67,12 +80,42 @@ def ticks_to_ms(ticks, tempo, ticks_per_beat):
     return int(round(micros / 1000.0))
 
 
+def _track_iter(track):
+    """
+    逐条产出某个轨道的 (abs_ticks, code, note, value) 整数元组，abs_ticks 为累加后的绝对 tick。
+
+    - code 为 `_MSG_CODES` 中的类型编码；与旋律无关的消息（控制器、歌词等）直接跳过。
+    - note_on / note_off：note 为音符号，value 为 velocity。
+      velocity==0 的 note_on 在这里就归一化为 note_off，后续循环无需再检查 velocity。
+    - set_tempo：note 固定为 0，value 为 tempo（microseconds per beat）。
+
+    mido.Message 的属性访问较慢，这里每条消息只解码一次，后续处理都只面对普通整数。
+    每个轨道内部的消息本来就按时间顺序排列，因此产出的序列天然有序，
+    可以直接交给 heapq.merge 做多路归并。
+    """
+    get_code = _MSG_CODES.get
+    abs_ticks = 0
+    for msg in track:
+        abs_ticks += msg.time
+        code = get_code(msg.type)
+        if code is None:
+            continue
+        if code == _MSG_SET_TEMPO:
+            yield abs_ticks, code, 0, msg.tempo
+            continue
+        velocity = msg.velocity
+        if velocity == 0:
+            code = _MSG_NOTE_OFF
+        yield abs_ticks, code, msg.note, velocity
+
+
 def extract_monophonic(mid):
     """
     从 MIDI 文件中提取单声道（单旋律）音符事件序列，返回每个音符的起止 tick。
 
     处理步骤（面向初学者）：
-    1. 把所有轨道的事件合并，并按绝对时间（ticks）排序，这样可以按照时间顺序处理事件。
+    1. 把所有轨道的事件按绝对时间（ticks）归并成一条有序的事件流，这样可以按照时间顺序处理事件。
+       每个轨道本身已经有序，所以用 heapq.merge 做多路归并，无需整体排序。
     2. 遇到 note_on（velocity>0）时记录该音符的起始 tick 和速度（velocity）；
        遇到 note_off 或 note_on（velocity==0）时记录结束 tick 并把该音符加入结果。
     3. 如果多个音符在同一 tick 同时开始（和弦），按优先级选择一个音符保留：
@@ -87,46 +130,54 @@ def extract_monophonic(mid):
     # 1) 合并所有轨道的消息并计算绝对 tick 时间
     ticks_per_beat = mid.ticks_per_beat
     tempo = 500000
-    events = []  # (abs_ticks, msg)
-    for i, track in enumerate(mid.tracks):
-        abs_ticks = 0
-        for msg in track:
-            abs_ticks += msg.time
-            events.append((abs_ticks, msg))
-    events.sort(key=lambda x: x[0])
+    # (abs_ticks, code, note, value)；同一 tick 上的事件保持轨道顺序（heapq.merge 是稳定的）
+    events = heapq.merge(*[_track_iter(track) for track in mid.tracks], key=lambda x: x[0])
 
     # 2) 记录处于按下状态的音符（active），并收集已经完成的 note 事件
-    active = {}  # note -> (on_tick, velocity)
-    results = []  # will hold (note, start_tick, end_tick, velocity)
+    # 完成的音符数不会超过消息总数，按此上限预分配结果列表，最后再截断
+    n_total = sum(len(track) for track in mid.tracks)
+    active = [None] * 128  # 按音符号索引：(on_tick, velocity) 或 None（未按下）
+    results = [None] * n_total  # will hold (note, start_tick, end_tick, velocity)
+    n_results = 0
 
-    for abs_tick, msg in events:
+    for abs_tick, code, note, value in events:
         # 处理 tempo 变化，供后续 ticks->时间 转换使用
-        if msg.type == 'set_tempo':
-            tempo = msg.tempo
-        # note_on 且 velocity>0 -> 开始音符
-        if msg.type == 'note_on' and msg.velocity > 0:
-            active[msg.note] = (abs_tick, msg.velocity)
-        # note_off 或 note_on 且 velocity==0 -> 结束音符
-        elif (msg.type == 'note_off') or (msg.type == 'note_on' and msg.velocity == 0):
-            if msg.note in active:
-                start_tick, vel = active.pop(msg.note)
-                results.append((msg.note, start_tick, abs_tick, vel))
+        if code == _MSG_SET_TEMPO:
+            tempo = value
+        # note_on（velocity>0）-> 开始音符
+        elif code == _MSG_NOTE_ON:
+            active[note] = (abs_tick, value)
+        # note_off（含 velocity==0 的 note_on）-> 结束音符
+        else:
+            on = active[note]
+            if on is not None:
+                active[note] = None
+                results[n_results] = (note, on[0], abs_tick, on[1])
+                n_results += 1
+    del results[n_results:]
 
     # 3) 按起始时间分组，同时开始的（和弦）只保留一个音符
+    # 排序后起始时间相同的音符必然相邻，一次线性扫描即可完成分组
     results.sort(key=lambda x: x[1])
 
-    by_start = {}
-    for note, s, e, vel in results:
-        by_start.setdefault(s, []).append((note, s, e, vel))
-
-    timeline = []
-    for s in sorted(by_start.keys()):
-        group = by_start[s]
+    timeline = [None] * n_results
+    n_timeline = 0
+    cur_s = None
+    best = None
+    for item in results:
+        if item[1] != cur_s:
+            if best is not None:
+                timeline[n_timeline] = best
+                n_timeline += 1
+            cur_s = item[1]
+            best = item
         # 选择 velocity 最大的音符；若 velocity 相同则选择音高更高的音符
-        chosen = max(group, key=lambda x: (x[3], x[0]))
-        timeline.append(chosen)
-
-    timeline.sort(key=lambda x: x[1])  # 确保时间顺序
+        elif (item[3], item[0]) > (best[3], best[0]):
+            best = item
+    if best is not None:
+        timeline[n_timeline] = best
+        n_timeline += 1
+    del timeline[n_timeline:]
 
     # 输出格式转换为 (note, start_tick, end_tick)
     output = [(note, s, e) for (note, s, e, vel) in timeline]
@@ -134,9 +185,11 @@ def extract_monophonic(mid):
     return output, tempo, ticks_per_beat
 
 
-def build_note_array(events, tempo, ticks_per_beat):
+def build_note_array_iter(events, tempo, ticks_per_beat):
     """
-    把提取到的事件（以 ticks 表示）转换为 (频率, 毫秒) 的列表，方便生成 C 头文件。
+    把提取到的事件（以 ticks 表示）逐条转换为 (频率, 毫秒)，以生成器形式产出。
+
+    后续的简化和输出阶段都可以直接消费这个生成器，不必先保存一份完整的音符列表。
 
     - events: 列表 (note_number, start_tick, end_tick)
     - tempo, ticks_per_beat: 用于 ticks -> ms 的转换
@@ -144,36 +197,48 @@ def build_note_array(events, tempo, ticks_per_beat):
     行为说明：
     - 如果某个音符开始时间 s 大于当前时间 current_tick，则说明当前存在间隔，
       把间隔时间转换为休止（freq=0，duration=间隔毫秒数）。
-    - 然后把实际音符的持续时间与对应频率加入输出。
+    - 然后产出实际音符的频率与持续时间。
+    - ticks -> ms 换算所用的整数分母 ticks_per_beat * 1000 在循环外算好一次，
+      每个值只需一次乘法和一次除法，结果与 ticks_to_ms 完全一致。
     """
-    notes = []
     if not events:
-        return notes
+        return
+    if tempo is None:
+        tempo = 500000  # 默认 120 BPM，与 ticks_to_ms 一致
+    ms_den = ticks_per_beat * 1000
+    midi_freq = _MIDI_FREQ  # 绑定为局部变量，循环内查表更快
     current_tick = events[0][1]
     for note, s, e in events:
         # 如果出现空白间隔，插入休止（freq==0）
         if s > current_tick:
-            rest_ms = ticks_to_ms(s - current_tick, tempo, ticks_per_beat)
+            rest_ms = int(round((s - current_tick) * tempo / ms_den))
             if rest_ms > 0:
-                notes.append((0, rest_ms))
+                yield 0, rest_ms
         # 计算音符持续时间并转换为频率
-        dur_ms = ticks_to_ms(e - s, tempo, ticks_per_beat)
-        freq = note_to_freq(note)
-        notes.append((freq, dur_ms))
+        dur_ms = int(round((e - s) * tempo / ms_den))
+        freq = midi_freq[note]
+        yield freq, dur_ms
         current_tick = e
-    return notes
 
 
 def emit_c_header(notes, out_path):
     """
     将 notes 写入 C 头文件，生成一个 `static const Note_t melody[]` 数组。
 
+    notes 可以是任意 (freq, duration) 可迭代对象（例如生成器），只会被遍历一次。
+    返回实际写入的条目数。
+
     注意点：
     - 使用 `freq==0` 表示休止（rest）。
     - 为避免生成负或 0 时长的条目，会跳过持续时间 <= 0 的项。
     - 生成的头文件包含头保护（#ifndef/#define）和 `melody_len` 计数变量，便于 C 端使用。
+    - 数组条目在打开文件之前就全部格式化好，再一次性写入，避免每个音符调用一次 write；
+      notes 转换过程中出错时会直接抛出异常，不会留下写了一半的头文件。
     """
     print(f"[emit_c_header] Writing header to: {out_path}", flush=True)
+    # 休止（freq==0）与普通音符格式相同
+    lines = ["  {%d, %d},\n" % (freq, dur) for freq, dur in notes if dur > 0]
+    count = len(lines)
     try:
         with open(out_path, 'w', encoding='utf-8') as f:
             f.write("/* Auto-generated by tools/midi_to_buzzer.py */\n")
@@ -183,21 +248,62 @@ def emit_c_header(notes, out_path):
             f.write("typedef struct {\n    uint16_t freq;\n    uint16_t duration;\n} Note_t;\n\n")
 
             f.write("static const Note_t melody[] = {\n")
-            for freq, dur in notes:
-                if dur <= 0:
-                    continue
-                if freq == 0:
-                    # 休止
-                    f.write(f"  {{0, {dur}}},\n")
-                else:
-                    f.write(f"  {{{freq}, {dur}}},\n")
+            f.write(''.join(lines))
             f.write("};\n\n")
             f.write("static const size_t melody_len = sizeof(melody)/sizeof(melody[0]);\n\n")
             f.write("#endif /* BADAPPLE_MELODY_H */\n")
-        print(f"[emit_c_header] Wrote {out_path} with {len(notes)} events", flush=True)
-    except Exception as ex:
+        print(f"[emit_c_header] Wrote {out_path} with {count} events", flush=True)
+    except OSError as ex:
         # 输出异常信息（对初学者有帮助）
         print(f"[emit_c_header] ERROR writing header: {ex}", flush=True)    
+        count = 0
+    return count
+
+
+def emit_binary_header(notes, out_path):
+    """
+    以二进制形式输出旋律：数据写入同名 `.bin` 文件，头文件只保留声明。
+
+    - `.bin` 中按 freq, duration, freq, duration, ... 顺序存放小端 uint16_t，
+      与 `Note_t` 数组的内存布局一致，C 端可用 INCBIN / `.incbin` 把它直接放进 Flash，
+      并把符号命名为 `melody`。
+    - 头文件保留 `Note_t` 定义并声明 `extern const Note_t melody[]`，`melody_len` 为音符条数（已写死），
+      因此 C 端仍可像文本头文件一样用 `melody[i].freq` / `melody[i].duration` 访问。
+    - 与 emit_c_header 一样跳过持续时间 <= 0 的项；时长超出 uint16 上限会被截断。
+    - `.bin` 路径为 out_path 去掉扩展名后加 `.bin`；若与 out_path 相同（out_path 本身以 .bin 结尾），
+      不写任何文件并返回 0。
+    - notes 可以是任意可迭代对象，返回实际写入的条目数；与 emit_c_header 一样，
+      数据在打开文件之前就已转换完毕。
+    """
+    bin_path = os.path.splitext(out_path)[0] + '.bin'
+    if os.path.normpath(bin_path) == os.path.normpath(out_path):
+        # 输出路径本身就是 .bin 时，头文件会覆盖刚写入的数据，直接拒绝
+        print(f"[emit_binary_header] ERROR: header path {out_path} is the same as the data file; use a non-.bin header name", flush=True)
+        return 0
+    print(f"[emit_binary_header] Writing {bin_path} and {out_path}", flush=True)
+    data = array('H', itertools.chain.from_iterable(
+        (freq, min(dur, 0xFFFF)) for freq, dur in notes if dur > 0))
+    if sys.byteorder != 'little':
+        data.byteswap()  # STM32 为小端
+    count = len(data) // 2
+    try:
+        with open(bin_path, 'wb') as f:
+            data.tofile(f)
+        with open(out_path, 'w', encoding='utf-8') as f:
+            f.write("/* Auto-generated by tools/midi_to_buzzer.py */\n")
+            f.write("#ifndef BADAPPLE_MELODY_H\n")
+            f.write("#define BADAPPLE_MELODY_H\n\n")
+            f.write("#include \"main.h\"\n\n")
+            f.write("typedef struct {\n    uint16_t freq;\n    uint16_t duration;\n} Note_t;\n\n")
+            f.write(f"/* Data: {os.path.basename(bin_path)}, little-endian uint16_t {{freq, duration}} pairs */\n")
+            f.write("extern const Note_t melody[];\n\n")
+            f.write(f"static const size_t melody_len = {count};\n\n")
+            f.write("#endif /* BADAPPLE_MELODY_H */\n")
+        print(f"[emit_binary_header] Wrote {bin_path} with {count} events", flush=True)
+    except OSError as ex:
+        print(f"[emit_binary_header] ERROR writing binary melody: {ex}", flush=True)
+        count = 0
+    return count
 
 
 def simplify_notes(notes, quarter_ms, denom=8, min_ms=80, max_notes=400):
@@ -206,13 +312,16 @@ def simplify_notes(notes, quarter_ms, denom=8, min_ms=80, max_notes=400):
 
     处理步骤：
     1. 合并相邻且频率相同的音符（它们会被当成一个更长的音符）。
+       合并与下面的量化在同一次遍历中完成：频率变化时才把上一段交给量化逻辑。
     2. 将每个音符的时长量化到最近的单位：unit = quarter_ms / denom。举例：
        如果 quarter_ms==500, denom==8，则 unit==62.5 ms。
+       内部把 unit 表示成整数分数 unit_num / unit_den（微秒 / (1000*denom)），
+       全程用整数运算完成四舍五入，避免每个音符都走浮点除法和 round。
     3. 如果量化后的时长小于 min_ms，则把该时间并入前一个音符（如果没有前一个，则转成休止）。
     4. 如果音符数量超过 max_notes，会把尾部时间合并到最后一个保留的条目中，以限制总长度。
 
     参数及含义：
-    - notes: 列表 (freq, duration_ms)
+    - notes: (freq, duration_ms) 的可迭代对象（列表或生成器均可，只遍历一次）
     - quarter_ms: 四分之一拍对应的毫秒数（由 tempo 决定）
     - denom: 量化分母（更大表示更细的时间网格）
     - min_ms: 最小保留时间，过短的时间会被合并
@@ -221,25 +330,28 @@ def simplify_notes(notes, quarter_ms, denom=8, min_ms=80, max_notes=400):
     返回：
     - 简化并量化后的列表 (freq, duration_ms)
     """
-    if not notes:
-        return []
-    unit = quarter_ms / denom
-
-    # 合并相邻相同频率的音符
-    merged = []
-    for f, d in notes:
-        if merged and merged[-1][0] == f:
-            merged[-1] = (f, merged[-1][1] + d)
-        else:
-            merged.append((f, d))
+    # unit = quarter_ms / denom = unit_num / unit_den
+    unit_num = int(round(quarter_ms * 1000))
+    unit_den = 1000 * denom
+    half = unit_num >> 1
 
-    # 量化时长并删除过短音符（把时间并入前一个条目）
+    # 合并相邻相同频率的音符，同时量化时长并删除过短音符（把时间并入前一个条目）
+    # 末尾追加一个哨兵条目 (None, 0)，保证最后一段也会被输出
     quant = []
-    for f, d in merged:
-        q = int(round(d / unit))
+    cur_f = None
+    cur_d = 0
+    for f, d in itertools.chain(notes, ((None, 0),)):
+        if f == cur_f:
+            cur_d += d
+            continue
+        # 频率变化：取出上一段 (f, d) 做量化，并从当前条目开始新的一段
+        f, d, cur_f, cur_d = cur_f, cur_d, f, d
+        if f is None:
+            continue
+        q = (d * unit_den + half) // unit_num
         if q <= 0:
             q = 1
-        d2 = int(q * unit)
+        d2 = (q * unit_num) // unit_den
         if d2 < min_ms:
             if quant:
                 quant[-1] = (quant[-1][0], quant[-1][1] + d2)
@@ -265,7 +377,7 @@ def simplify_notes(notes, quarter_ms, denom=8, min_ms=80, max_notes=400):
 
 def main():
     # 命令行参数说明：
-    #   python tools/midi_to_buzzer.py <midi-file> <out-h-header> [--simplify] [--denom=N] [--min-ms=N] [--max-notes=N] [--monophonic]
+    #   python tools/midi_to_buzzer.py <midi-file> <out-h-header> [--simplify] [--denom=N] [--min-ms=N] [--max-notes=N] [--monophonic] [--binary]
     if len(sys.argv) < 3:
         print("用法: python tools/midi_to_buzzer.py <midi-file> <out-h-header>")
         sys.exit(1)
@@ -283,8 +395,6 @@ def main():
     # 提取单声道事件并转换为 (note, start, end)
     events, tempo, tpb = extract_monophonic(mid)
     print(f"[main] 提取到事件数量: {len(events)}, tempo={tempo}, tpb={tpb}", flush=True)
-    notes = build_note_array([(n, s, e) for (n, s, e) in events], tempo, tpb)
-    print(f"[main] 构建的音符列表长度: {len(notes)}", flush=True)
 
     # 可选的简化参数
     simplify = False
@@ -292,6 +402,7 @@ def main():
     min_ms = 80
     max_notes = 400
     monophonic = False
+    binary = False
     for a in sys.argv[3:]:
         if a.startswith('--simplify'):
             simplify = True
@@ -312,21 +423,40 @@ def main():
                 pass
         if a.startswith('--monophonic') or a.startswith('--preserve-length'):
             monophonic = True
+        if a.startswith('--binary'):
+            binary = True
+
+    # --binary 时改为输出 .bin 数据 + 仅含声明的头文件
+    emit = emit_binary_header if binary else emit_c_header
+
+    # 音符以生成器形式逐条产出，直接交给简化/输出阶段：
+    # --simplify 时只保存简化后的列表；直接输出时 emit 函数会在打开文件前
+    # 把全部条目转换并格式化好（出错时不会留下残缺的头文件）
+    notes = build_note_array_iter(events, tempo, tpb)
 
     # 根据参数选择输出：保留单声道、简化或直接输出原始音符
     if monophonic:
         mono_out = out_header.replace('.h', '_mono.h')
-        emit_c_header(notes, mono_out)
-        print(f"[main] 已写入单声道头文件: {mono_out} (events: {len(notes)})", flush=True)
+        count = emit(notes, mono_out)
+        print(f"[main] 已写入单声道头文件: {mono_out} (events: {count})", flush=True)
     elif simplify:
         # 计算四分之一拍的毫秒数用于量化
         quarter_ms = tempo / 1000.0
-        simple_notes = simplify_notes(notes, quarter_ms, denom=denom, min_ms=min_ms, max_notes=max_notes)
+        original_count = 0
+
+        def counted(it):
+            # 边遍历边计数，得到原始音符条数而无需保存完整列表
+            nonlocal original_count
+            for item in it:
+                original_count += 1
+                yield item
+
+        simple_notes = simplify_notes(counted(notes), quarter_ms, denom=denom, min_ms=min_ms, max_notes=max_notes)
         simple_out = out_header.replace('.h', '_simple.h')
-        emit_c_header(simple_notes, simple_out)
-        print(f"[main] 已写入简化头文件: {simple_out} (原始 {len(notes)} -> 简化 {len(simple_notes)})", flush=True)
+        emit(simple_notes, simple_out)
+        print(f"[main] 已写入简化头文件: {simple_out} (原始 {original_count} -> 简化 {len(simple_notes)})", flush=True)
     else:
-        emit_c_header(notes, out_header)
+        emit(notes, out_header)
 
 
 if __name__ == '__main__':
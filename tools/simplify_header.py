@@ -10,16 +10,23 @@ simplify_header.py
 用法示例：
   python tools/simplify_header.py Core/Src/badapple_melody.h Core/Src/badapple_melody_simple.h
 """
+import itertools
 import re
 import sys
+from statistics import median_high
+
+# 匹配形如 `{123, 456},` 的 melody 条目
+_NOTE_RE = re.compile(r"\{\s*(\d+)\s*,\s*(\d+)\s*\},")
 
 def parse_header(path):
     """
     解析 C 头文件中的 melody 数组，提取 (freq, duration) 列表。
 
     实现细节：
-    - 使用正则 `\\{\\s*(\\d+)\\s*,\\s*(\\d+)\\s*\\},` 匹配形如 `{123, 456},` 的条目。
+    - 使用模块级预编译的正则 `_NOTE_RE`（`\\{\\s*(\\d+)\\s*,\\s*(\\d+)\\s*\\},`）匹配形如 `{123, 456},` 的条目。
       （注意：在此 docstring 中反斜杠已转义为 `\\`，以避免 Python 报告 SyntaxWarning）
+    - 一次性读入整个文件，再用 `findall` 在整段文本上匹配（正则循环在 C 中完成，
+      比逐行调用 search 更快）。
     - 只提取数字并返回一个列表，格式为 [(freq, dur), ...]。
 
     参数：
@@ -28,15 +35,9 @@ def parse_header(path):
     返回：
     - notes: 列表，元素为 (freq, dur) 的整数元组
     """
-    pattern = re.compile(r"\{\s*(\d+)\s*,\s*(\d+)\s*\},")
-    notes = []
     with open(path, 'r', encoding='utf-8') as f:
-        for line in f:
-            m = pattern.search(line)
-            if m:
-                freq = int(m.group(1))
-                dur = int(m.group(2))
-                notes.append((freq, dur))
+        text = f.read()
+    notes = [(int(freq), int(dur)) for freq, dur in _NOTE_RE.findall(text)]
     return notes
 
 
@@ -46,13 +47,14 @@ def simplify_notes(notes, unit_ms=128, min_ms=80, max_notes=300):
 
     步骤说明（面向初学者）：
     1. 合并相邻相同频率的音符（使其成为一个更长的音符）。
+       合并与量化在同一次遍历中完成，不再生成中间列表。
     2. 将每个音符的时长四舍五入到 unit_ms 的整数倍（time quantization）。
     3. 如果量化后时长小于 min_ms，则把该时间并入前一个条目（或在开头转为休止）。
     4. 如果输出条目数超过 max_notes，则把尾部时间合并到最后一个保留条目中。
 
     参数：
     - notes: 原始列表 [(freq, dur_ms), ...]
-    - unit_ms: 量化单位（毫秒）
+    - unit_ms: 量化单位（毫秒，整数；量化全程使用整数四舍五入）
     - min_ms: 最小保留时长（毫秒）
     - max_notes: 最大允许的条目数
 
@@ -61,19 +63,23 @@ def simplify_notes(notes, unit_ms=128, min_ms=80, max_notes=300):
     """
     if not notes:
         return []
-    merged = []
-    for f, d in notes:
-        if merged and merged[-1][0] == f:
-            merged[-1] = (f, merged[-1][1] + d)
-        else:
-            merged.append((f, d))
-
+    # 末尾追加哨兵条目 (None, 0)，保证最后一段也会被量化输出
+    half = unit_ms // 2
     quant = []
-    for f, d in merged:
-        q = int(round(d / unit_ms))
+    cur_f = None
+    cur_d = 0
+    for f, d in itertools.chain(notes, ((None, 0),)):
+        if f == cur_f:
+            cur_d += d
+            continue
+        # 频率变化：取出上一段 (f, d) 做量化，并从当前条目开始新的一段
+        f, d, cur_f, cur_d = cur_f, cur_d, f, d
+        if f is None:
+            continue
+        q = (d + half) // unit_ms
         if q <= 0:
             q = 1
-        d2 = int(q * unit_ms)
+        d2 = q * unit_ms
         if d2 < min_ms:
             if quant:
                 quant[-1] = (quant[-1][0], quant[-1][1] + d2)
@@ -103,6 +109,7 @@ def emit_header(notes, out_path, guard_name='BADAPPLE_MELODY_SIMPLE_H'):
     - 把负值时长转换为 0，超出 uint16 最大值的时长会被截断为 0xFFFF，
       以避免生成会导致 C 端溢出的常量。
     - 生成包含头保护（#ifndef/#define）和 `melody_len` 的完整头文件。
+    - 所有条目先拼接成一个字符串再一次性写入，避免每个音符调用一次 write。
     """
     MAX_UINT16 = 0xFFFF
     with open(out_path, 'w', encoding='utf-8') as f:
@@ -112,13 +119,9 @@ def emit_header(notes, out_path, guard_name='BADAPPLE_MELODY_SIMPLE_H'):
         f.write('#include "main.h"\n\n')
         f.write('typedef struct {\n    uint16_t freq;\n    uint16_t duration;\n} Note_t;\n\n')
         f.write('static const Note_t melody[] = {\n')
-        for freq, dur in notes:
-            if dur < 0:
-                dur = 0
-            if dur > MAX_UINT16:
-                # 超出 uint16 上限则截断
-                dur = MAX_UINT16
-            f.write(f'  {{{freq}, {dur}}},\n')
+        # 负值记为 0，超出 uint16 上限则截断
+        f.write(''.join('  {%d, %d},\n' % (freq, min(max(dur, 0), MAX_UINT16))
+                        for freq, dur in notes))
         f.write('};\n\n')
         f.write('static const size_t melody_len = sizeof(melody)/sizeof(melody[0]);\n\n')
         f.write(f'#endif /* {guard_name} */\n')
@@ -138,8 +141,8 @@ def main():
     # 这里使用中位数 * 4 / 8 的方式来估计量化单位（与 midi_to_buzzer 的策略匹配）。
     durs = [d for f, d in notes if d>0]
     if durs:
-        durs_sorted = sorted(durs)
-        q = durs_sorted[len(durs_sorted)//2] * 4
+        # median_high 即排序后下标 len//2 处的元素（偶数个时取较大的中位数）
+        q = median_high(durs) * 4
         unit = int(round(q / 8))
     else:
         unit = 128